@@ -1,10 +1,34 @@
+import time
+start_time = time.perf_counter()
+
 from binaryninja import *
-from . import pre_process
 
 
 def run(bv: BinaryView):
     log.log_to_file(0, 'pre_proc_log.txt')
+    # pre_process pulls in libclang, the ast handlers and the library configs, only import it when actually used.
+    from . import pre_process
     pre_process.pp(bv)
 
 
+def start_type_query_daemon(bv: BinaryView):
+    from . import type_query_daemon
+    type_query_daemon.serve()
+
+
+def diff_typelibs(bv: BinaryView):
+    from . import typelib_diff
+    old_path = get_open_filename_input('Old typelib build (.btl or manifest .json)', '*.btl *.json')
+    new_path = get_open_filename_input('New typelib build (.btl or manifest .json)', '*.btl *.json')
+    if not old_path or not new_path:
+        return
+    report = typelib_diff.diff_files(old_path, new_path)
+    show_plain_text_report('Typelib diff', typelib_diff.format_report(report))
+
+
 PluginCommand.register('preproc', 'preproc', run)
+PluginCommand.register('preproc - type query daemon', 'Serve type queries from the processed typelibs',
+                       start_type_query_daemon)
+PluginCommand.register('preproc - diff typelibs', 'Structural diff between two builds of a typelib', diff_typelibs)
+
+log.log_debug(f'PreProcess_headers: Plugin loaded in {(time.perf_counter() - start_time) * 1000:.3f} ms')
@@ -2,6 +2,7 @@ import binaryninja as bn
 from clang.cindex import *
 from typing import *
 import xxhash
+from . import deferred
 
 # Keys are the original spelling of the type\object name in the header file, the Value is the name entered into
 # the binaryView.
@@ -32,6 +33,11 @@ def define_type(node: Cursor, bv: bn.BinaryView):
     # Dispatch the correct handler for the declaration recursively.
     # It is important to check for type kind before we check for cursor kind in order
     # to detect arrays and such.
+    if deferred.waits_on_deferred(node):
+        # The type is deferred - the binaryView may hold an empty forward decl placeholder for it (see struct_decl), so
+        # it must not be treated as already defined. The caller defers itself until the type is defined.
+        bn.log.log_debug(f'define_type: {node.type.spelling} {node.spelling} is deferred, not defining it yet.')
+        return
     if node.spelling:
         # For some reason libclang parses some typedefs (usually ENUM_DECL) as having no spelling, but doesn't
         # recognize them as anonymous.
@@ -126,7 +132,11 @@ def pointer_type(node: Cursor, bv: bn.BinaryView):
                 #                                                   DWORD Reason,
                 #                                                   PVOID Reserved
                 #                                                 );
-                bn_pointee_name, bn_pointee_type = function_decl(node, bv)
+                result = function_decl(node, bv)
+                if result is None:
+                    deferred.defer(node, bv, pointer_type)
+                    return
+                bn_pointee_name, bn_pointee_type = result
                 pointer = bn.Type.pointer(bv.arch, bn_pointee_type)
             elif pointee_type.kind == TypeKind.FUNCTIONNOPROTO:
                 # FUNCTIONNOPROTO means there are no arguments, only a possible return type
@@ -140,7 +150,11 @@ def pointer_type(node: Cursor, bv: bn.BinaryView):
                     bn_result_type, bn_result_name = bv.parse_type_string(pointee_result_string)
                 else:
                     result_type = pointee_type.get_result().get_declaration()
-                    bn_result_name, bn_result_type = define_type(result_type, bv)
+                    result = define_type(result_type, bv)
+                    if result is None:
+                        deferred.defer(node, bv, pointer_type)
+                        return
+                    bn_result_name, bn_result_type = result
                 pointer = bn.Type.pointer(bv.arch, bn.Type.function(bn_result_type, []))
             elif pointee_type.kind == TypeKind.POINTER:
                 # we are dealing with a pointer to a pointer
@@ -162,7 +176,11 @@ def pointer_type(node: Cursor, bv: bn.BinaryView):
                     if check_if_base_type(current_pointer_type):
                         bn_pointee_type, bn_pointee_name = bv.parse_type_string(current_pointer_type.spelling)
                     else:
-                        bn_pointee_name, bn_pointee_type = define_type(current_pointer_type, bv)
+                        result = define_type(current_pointer_type, bv)
+                        if result is None:
+                            deferred.defer(node, bv, pointer_type)
+                            return
+                        bn_pointee_name, bn_pointee_type = result
                     temp_bn_pointer_type = bn.Type.pointer(bv.arch, bn_pointee_type)
                     for nesting_level in range(nested_pointer_count):
                         temp_bn_pointer_type = bn.Type.pointer(bv.arch, temp_bn_pointer_type)
@@ -177,7 +195,11 @@ def pointer_type(node: Cursor, bv: bn.BinaryView):
                     # easier to just parse the pointer to a known type then parse the underlying type.
                     bn_pointee_type, bn_pointee_name = bv.parse_type_string(pointee_type.spelling)
                 else:
-                    bn_pointee_name, bn_pointee_type = define_type(pointee_type.get_pointee().get_declaration(), bv)
+                    result = define_type(pointee_type.get_pointee().get_declaration(), bv)
+                    if result is None:
+                        deferred.defer(node, bv, pointer_type)
+                        return
+                    bn_pointee_name, bn_pointee_type = result
                 pointer = bn.Type.pointer(bv.arch, bn_pointee_type)
             else:
                 bn_pointee_type, bn_pointee_name = bv.parse_type_string(node.underlying_typedef_type.spelling)
@@ -186,7 +208,11 @@ def pointer_type(node: Cursor, bv: bn.BinaryView):
             bn_pointee_type = bv.get_type_by_name(pointee_node.spelling)
             if bn_pointee_type is None:
                 # need to define the pointee type before declaring the pointer
-                bn_pointee_name, bn_pointee_type = define_type(pointee_node, bv)
+                result = define_type(pointee_node, bv)
+                if result is None:
+                    deferred.defer(node, bv, pointer_type)
+                    return
+                bn_pointee_name, bn_pointee_type = result
                 pointer = bn.Type.pointer(bv.arch, bn_pointee_type)
             else:
                 # type already defined in the binaryView.
@@ -227,7 +253,11 @@ def constantarray_type(node: Cursor, bv: bn.BinaryView):
     elif node.type.get_array_element_type().get_declaration().is_anonymous():
         # Anonymous struct\union\enum as the array member type
         element_type_node = node.type.get_array_element_type().get_declaration()
-        anonymous_name, bn_anonymous_type = define_anonymous_type(element_type_node, bv)
+        result = define_anonymous_type(element_type_node, bv)
+        if result is None:
+            deferred.defer(node, bv, constantarray_type)
+            return
+        anonymous_name, bn_anonymous_type = result
         array = bn.Type.array(bn_anonymous_type, node.type.get_array_size())
         bn.log.log_debug(f'constantarray_type: Successfully proccessed anonymous type: {bn_anonymous_type} .')
     else:
@@ -267,7 +297,11 @@ def constantarray_type(node: Cursor, bv: bn.BinaryView):
             if not array:
                 # If array is defined at this point it means we have an array of pointers or a matrix, in which case
                 # it was already handled and defined above.
-                bn_element_name, bn_element_type = define_type(element_type_node, bv)
+                result = define_type(element_type_node, bv)
+                if result is None:
+                    deferred.defer(node, bv, constantarray_type)
+                    return
+                bn_element_name, bn_element_type = result
                 array = bn.Type.array(bn_element_type, node.type.get_array_size())
     bv.define_user_type(node.spelling, array)
     bn.log.log_debug(f'constantarray_type: Successfully defined: {node.type.spelling} {node.spelling}')
@@ -293,10 +327,18 @@ def incompletearray_type(node: Cursor, bv: bn.BinaryView):
                 pointee_type_string = 'void'
             pointee_var_type, pointee_var_name = bv.parse_type_string(pointee_type_string)
         else:
-            pointee_var_name, pointee_var_type = define_type(bn_array_element_type.get_pointee().get_declaration(), bv)
+            result = define_type(bn_array_element_type.get_pointee().get_declaration(), bv)
+            if result is None:
+                deferred.defer(node, bv, incompletearray_type)
+                return
+            pointee_var_name, pointee_var_type = result
         var_type = bn.Type.pointer(bv.arch, pointee_var_type)
     else:
-        var_name, var_type = define_type(bn_array_element_type.get_declaration(), bv)
+        result = define_type(bn_array_element_type.get_declaration(), bv)
+        if result is None:
+            deferred.defer(node, bv, incompletearray_type)
+            return
+        var_name, var_type = result
     array = bn.Type.array(var_type, INCOMPLETE_ARRAY_ARBITRARY_SIZE)
 
     return node.spelling, array
@@ -324,6 +366,8 @@ def typedef_decl(node: Cursor, bv: bn.BinaryView):
             var_type, name = bv.parse_type_string(f'{node.type.spelling} {node.spelling}')
         except Exception as e:
             bn.log.log_debug(f'typedef_decl: Failed to parse {node.type.spelling} {node.spelling}, with exception {e}')
+            deferred.defer(node, bv, typedef_decl, e)
+            return
     else:
 
         # Sanitize the type - remove any compiler directives such as __aligned and such.
@@ -344,10 +388,17 @@ def typedef_decl(node: Cursor, bv: bn.BinaryView):
                     altered_spelling = node.spelling[:-1] + 'T'
                     var_type, name = bv.parse_type_string(f'{underlying_typedef_type_string} {altered_spelling}')
                 elif 'is not defined' in str(se):
-                    var_type, name = bv.define_user_type(underlying_typedef_type_string)
+                    # The underlying type is declared later on in the header, retry once it is defined.
+                    deferred.defer(node, bv, typedef_decl, se)
+                    return
                 else:
                     bn.log.log_debug(f'typedef_decl: Failed to parse {node.underlying_typedef_type.spelling} '
                                      f'{node.spelling}')
+                    deferred.defer(node, bv, typedef_decl, se)
+                    return
+            else:
+                deferred.defer(node, bv, typedef_decl, se)
+                return
 
     try:
         bv.define_user_type(name, var_type)
@@ -357,6 +408,7 @@ def typedef_decl(node: Cursor, bv: bn.BinaryView):
     except Exception as e:
         bn.log.log_debug(f'typedef_decl: Failed Processing {node.underlying_typedef_type.spelling} '
                          f'{node.spelling} with exception {e}')
+        deferred.defer(node, bv, typedef_decl, e)
 
 
 def remove_compiler_directives(type_str: str):
@@ -370,9 +422,8 @@ def remove_compiler_directives(type_str: str):
 
 def var_decl(node: Cursor, bv: bn.BinaryView):
     bn.log.log_debug(f'var_decl: Processing var {node.underlying_typedef_type.spelling} {node.spelling}')
-    var_type, name = bv.parse_type_string(f'{node.type.spelling} {node.spelling}')
-
     try:
+        var_type, name = bv.parse_type_string(f'{node.type.spelling} {node.spelling}')
         bv.define_user_type(name, var_type)
         bn.log.log_debug(f'var_decl: Successfully processed var {node.underlying_typedef_type.spelling} '
                          f'{node.spelling}')
@@ -380,6 +431,7 @@ def var_decl(node: Cursor, bv: bn.BinaryView):
     except Exception as e:
         bn.log.log_debug(f'var_decl: Failed Processing var {node.underlying_typedef_type.spelling} {node.spelling} '
                          f'with exception {e}')
+        deferred.defer(node, bv, var_decl, e)
 
 
 def function_decl(node: Cursor, bv: bn.BinaryView):
@@ -426,14 +478,20 @@ def function_decl(node: Cursor, bv: bn.BinaryView):
                 elif param_type.get_array_element_type().kind == TypeKind.POINTER:
                     # Example: int *a[]
                     # The pointer type has no declaration node so can't call define_type() directly.
-                    pointee_name, pointee_type = define_type(
-                        param_type.get_array_element_type().get_pointee().get_declaration(), bv
-                    )
+                    result = define_type(param_type.get_array_element_type().get_pointee().get_declaration(), bv)
+                    if result is None:
+                        deferred.defer(node, bv, function_decl)
+                        return
+                    pointee_name, pointee_type = result
                     arr_var_type = bn.Type.pointer(bv.arch, pointee_type)
                     # TODO: Need to figure out a way to get the name of a parameter of this type.
                     var_name = ''
                 else:
-                    var_name, arr_var_type = define_type(param_type.get_array_element_type().get_declaration(), bv)
+                    result = define_type(param_type.get_array_element_type().get_declaration(), bv)
+                    if result is None:
+                        deferred.defer(node, bv, function_decl)
+                        return
+                    var_name, arr_var_type = result
                 var_type = bn.Type.array(arr_var_type, INCOMPLETE_ARRAY_ARBITRARY_SIZE)
             else:
                 var_type, var_name = bv.parse_type_string(f'{remove_compiler_directives(param_type.spelling)}')
@@ -476,7 +534,11 @@ def function_decl(node: Cursor, bv: bn.BinaryView):
             for param in node.get_arguments():
                 bn.log.log_debug(f'function_decl: Processing parameter - {param.type.spelling} {param.spelling} \n'
                                  f'               param.kind: {param.kind}, param.type.kind: {param.type.kind}')
-                var_name, var_type = define_type(param, bv)
+                result = define_type(param, bv)
+                if result is None:
+                    deferred.defer(node, bv, function_decl)
+                    return
+                var_name, var_type = result
                 p = bn.FunctionParameter(var_type, str(var_name))
                 func_params.append(p)
                 bn.log.log_debug(f'function_decl: Successfully Processed parameter - {param.type.spelling} '
@@ -506,6 +568,7 @@ def function_decl(node: Cursor, bv: bn.BinaryView):
         return node.spelling, function_type
     except Exception as e:
         bn.log.log_debug(f'function_decl: Failed Processing function {node.spelling} with exception {e}')
+        deferred.defer(node, bv, function_decl, e)
 
 
 def enum_decl(node: Cursor, bv: bn.BinaryView):
@@ -525,6 +588,7 @@ def enum_decl(node: Cursor, bv: bn.BinaryView):
         return node.spelling, bn.Type.enumeration_type(bv.arch, enum)
     except Exception as e:
         bn.log.log_debug(f'enum_decl: Failed Processing enum {node.spelling} with exception {e}')
+        deferred.defer(node, bv, enum_decl, e)
 
 
 def struct_decl(node: Cursor, bv: bn.BinaryView):
@@ -566,7 +630,16 @@ def struct_decl(node: Cursor, bv: bn.BinaryView):
                 var_type = bv.get_type_by_name(field.spelling)
                 if not var_type:
                     # Need to define the field type
-                    var_name, var_type = define_type(field.get_definition(), bv)
+                    field_result = define_type(field.get_definition(), bv)
+                    if field_result is None:
+                        # The field type could not be defined (usually because it depends on a type that is not
+                        # yet defined), appending it would corrupt the struct layout - defer the whole struct and
+                        # leave the forward decl in place until it is retried.
+                        bn.log.log_debug(f'struct_decl: Failed Processing struct field {field.spelling}, deferring '
+                                         f'struct {struct_name}')
+                        deferred.defer(node, bv, struct_decl)
+                        return
+                    var_name, var_type = field_result
                 struct.append(var_type, field.spelling)
             bn.log.log_debug(f'struct_decl: Successfully processed  struct field {field.spelling}')
 
@@ -580,6 +653,7 @@ def struct_decl(node: Cursor, bv: bn.BinaryView):
         return struct_name, bn.Type.structure_type(struct)
     except Exception as e:
         bn.log.log_debug(f'struct_decl: Failed Processing struct {struct_name} with exception {e}')
+        deferred.defer(node, bv, struct_decl, e)
 
 
 def define_anonymous_type(node: Cursor, bv: bn.BinaryView) -> bn.Type:
@@ -601,7 +675,11 @@ def define_anonymous_type(node: Cursor, bv: bn.BinaryView) -> bn.Type:
             # if field.is_anonymous():
             #    field_name, bn_field_type = define_anonymous_type(field, bv)
             # else:
-            field_name, bn_field_type = define_type(field.get_definition(), bv)
+            result = define_type(field.get_definition(), bv)
+            if result is None:
+                # An anonymous type is not defined on its own, the enclosing declaration defers itself.
+                return
+            field_name, bn_field_type = result
         bn.log.log_debug(f'define_anonymous_type: Appending field - {bn_field_type} {field_name}')
         struct.append(bn_field_type, field_name)
 
@@ -643,3 +721,4 @@ def field_decl(node: Cursor, bv: bn.BinaryView):
             bn.log.log_debug(f'field_decl: Unhandled recursive field {node.type.spelling} {node.spelling}')
     except Exception as e:
         bn.log.log_debug(f'field_decl: Failed Processing field {node.type.spelling} {node.spelling}')
+        deferred.defer(node, bv, field_decl, e)
@@ -0,0 +1,227 @@
+import binaryninja as bn
+from typing import *
+import json
+import os
+import shutil
+import threading
+import time
+import xxhash
+from . import directories_config
+
+# A ccache style cache of finished typelibs.
+# The typelib of a library is fully determined by the contents of its include chain, its config (clang args,
+# pre_load_definition and forward_declarations) and the code that processes it. All of those are hashed into a key,
+# and the finished artifacts are stored under that key, so an unchanged library can be restored without starting
+# libclang at all.
+# The include chain is only known after libclang parsed the header, so the lookup is done in two steps (like ccache
+# direct mode):
+#   1. The manifest key is a hash of the library config and the code version. The manifest stored under it lists the
+#      files of the include chain recorded by the last build.
+#   2. The result key is a hash of the manifest key and the contents of those files, the artifacts are stored under it.
+#
+# Cache folder layout:
+#   manifests/<manifest key>.json
+#   results/<result key>/<artifact files> + metadata.json
+#   stats.json
+
+# Source files whose code determines the produced typelib.
+code_files = ('ast_handlers.py', 'deferred.py', 'pre_process.py', 'typelib_diff.py')
+
+MANIFESTS_FOLDER = 'manifests'
+RESULTS_FOLDER = 'results'
+METADATA_FILE = 'metadata.json'
+STATS_FILE = 'stats.json'
+
+# Size of the chunks used when hashing file contents.
+HASH_CHUNK_SIZE = 0x100000
+
+
+def cache_path(*parts: str) -> str:
+    return os.path.join(directories_config.build_cache_folder, *parts)
+
+
+def hash_file(file_path: str, hasher) -> bool:
+    # Feed the contents of a file into the hasher, returns False if the file can't be read.
+    try:
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        return True
+    except OSError:
+        return False
+
+
+def code_version() -> str:
+    hasher = xxhash.xxh64()
+    plugin_folder = os.path.dirname(os.path.abspath(__file__))
+    for file_name in code_files:
+        hasher.update(file_name.encode())
+        hash_file(os.path.join(plugin_folder, file_name), hasher)
+    return hasher.hexdigest()
+
+
+def manifest_key(library) -> str:
+    config = {
+        'library': library.__name__,
+        'header_list': library.header_list,
+        'pre_proccessor_args': library.pre_proccessor_args,
+        'define_list': library.define_list,
+        'target_arch': library.target_arch,
+        'pre_load_definition': library.pre_load_definition,
+        'forward_declarations': library.forward_declarations,
+        'code_version': code_version()
+    }
+    return xxhash.xxh64_hexdigest(json.dumps(config, sort_keys=True).encode())
+
+
+def result_key(key: str, include_files: List[str]) -> Optional[str]:
+    # Returns None if one of the include files no longer exists.
+    hasher = xxhash.xxh64(key.encode())
+    for include_file in include_files:
+        hasher.update(include_file.encode())
+        if not hash_file(include_file, hasher):
+            return None
+    return hasher.hexdigest()
+
+
+def read_json(file_path: str, default=None):
+    try:
+        with open(file_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(file_path: str, data):
+    # Written to a temporary file which then replaces file_path, so an interrupted write (or a concurrent reader) never
+    # sees a truncated file.
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_file = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(temp_file, file_path)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+def stats() -> Dict:
+    return read_json(cache_path(STATS_FILE), {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0})
+
+
+def update_stats(**increments: int):
+    current_stats = stats()
+    for name, increment in increments.items():
+        current_stats[name] = current_stats.get(name, 0) + increment
+    write_json(cache_path(STATS_FILE), current_stats)
+
+
+def link_or_copy(source: str, destination: str):
+    # Hardlink the artifact when possible, fallback to a copy (e.g cache and destination on different volumes).
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def break_hardlink(path: str):
+    # Outputs restored from the cache may be hardlinks to a cached artifact. Writing to such an output in place would
+    # also overwrite the cached artifact, so the link is removed right before the output is written again.
+    if os.path.exists(path) and os.stat(path).st_nlink > 1:
+        os.remove(path)
+
+
+def get(library, outputs: Dict[str, str]) -> bool:
+    # Restore the cached artifacts of the library.
+    # outputs maps an artifact name (e.g 'type_lib.btl') to the path it should be restored to.
+    # Returns True on a cache hit.
+    key = manifest_key(library)
+    manifest = read_json(cache_path(MANIFESTS_FOLDER, f'{key}.json'))
+    result_folder = None
+    if manifest:
+        key = result_key(key, manifest['include_files'])
+        if key:
+            result_folder = cache_path(RESULTS_FOLDER, key)
+
+    # An entry without metadata is incomplete (put() was interrupted before finishing it) and is treated as a miss.
+    if not result_folder or not read_json(os.path.join(result_folder, METADATA_FILE)) or \
+            not all(os.path.isfile(os.path.join(result_folder, name)) for name in outputs):
+        bn.log.log_info(f'build_cache: Miss for {library.__name__}')
+        update_stats(misses=1)
+        return False
+
+    for name, destination in outputs.items():
+        link_or_copy(os.path.join(result_folder, name), destination)
+    # Touch the metadata to mark the entry as recently used for the LRU eviction.
+    os.utime(os.path.join(result_folder, METADATA_FILE))
+    bn.log.log_info(f'build_cache: Hit for {library.__name__}, restored {list(outputs.values())}')
+    update_stats(hits=1)
+    return True
+
+
+def put(library, include_files: List[str], outputs: Dict[str, str]):
+    # Store the artifacts of a finished build.
+    # include_files is the full include chain of the library as reported by libclang.
+    key = manifest_key(library)
+    include_files = sorted(set(include_files))
+    key_of_result = result_key(key, include_files)
+    if key_of_result is None:
+        bn.log.log_info(f'build_cache: Include chain of {library.__name__} could not be read, not caching.')
+        return
+
+    result_folder = cache_path(RESULTS_FOLDER, key_of_result)
+    os.makedirs(result_folder, exist_ok=True)
+    for name, source in outputs.items():
+        shutil.copy2(source, os.path.join(result_folder, name))
+    write_json(os.path.join(result_folder, METADATA_FILE), {
+        'library': library.__name__,
+        'manifest_key': key,
+        'result_key': key_of_result,
+        'code_version': code_version(),
+        'include_files': include_files,
+        'artifacts': list(outputs.keys()),
+        'build_time': time.strftime('%Y-%m-%d %H:%M:%S')
+    })
+    write_json(cache_path(MANIFESTS_FOLDER, f'{key}.json'), {'include_files': include_files, 'outputs': outputs})
+    update_stats(stores=1)
+    bn.log.log_info(f'build_cache: Stored {library.__name__} under {key_of_result}')
+    evict()
+
+
+def folder_size(folder: str) -> int:
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for file_name in files:
+            size += os.path.getsize(os.path.join(root, file_name))
+    return size
+
+
+def evict(max_size: int = None):
+    # Remove the least recently used results until the cache size is below max_size.
+    if max_size is None:
+        max_size = directories_config.build_cache_max_size
+    results_folder = cache_path(RESULTS_FOLDER)
+    if not os.path.isdir(results_folder):
+        return
+
+    entries = list()
+    for key in os.listdir(results_folder):
+        result_folder = os.path.join(results_folder, key)
+        metadata_file = os.path.join(result_folder, METADATA_FILE)
+        last_used = os.path.getmtime(metadata_file) if os.path.exists(metadata_file) else 0
+        entries.append((last_used, folder_size(result_folder), result_folder))
+
+    total_size = sum(size for last_used, size, result_folder in entries)
+    evicted_count = 0
+    for last_used, size, result_folder in sorted(entries):
+        if total_size <= max_size:
+            break
+        shutil.rmtree(result_folder, ignore_errors=True)
+        total_size -= size
+        evicted_count += 1
+        bn.log.log_debug(f'build_cache: Evicted {result_folder}')
+    if evicted_count:
+        update_stats(evictions=evicted_count)
@@ -0,0 +1,229 @@
+import binaryninja as bn
+from clang.cindex import *
+from typing import *
+from collections import Counter
+import json
+
+# Declarations that failed to be defined because a type they depend on was not yet defined in the binaryView.
+# Keys are a unique key of the declaration (see declaration_key()), the Value is a dict describing the failure (see
+# defer()).
+# Libclang walks the header in source order, so a declaration can reference a type that is only defined later on.
+# Instead of re-running the whole build after editing forward_declarations, the failed declarations are kept here
+# and retried once the types they are missing appear in the binaryView.
+deferred_declarations = dict()
+
+# Number of deferred declarations per declaration name, used to find out if a type name is still deferred.
+# struct_decl leaves an empty forward decl placeholder in the binaryView for a deferred struct, so a deferred name can
+# not be considered defined just because bv.get_type_by_name() returns a type for it.
+deferred_names = Counter()
+
+# Declarations that are still failing after all retry passes were exhausted.
+failed_declarations = dict()
+
+# Maximum number of passes over the deferred declarations before giving up on them.
+MAX_RETRY_PASSES = 8
+
+# Members of a declaration are never deferred on their own, since they can't be defined outside of it.
+# The handler of the enclosing struct\function defers the whole declaration instead.
+member_kinds = (CursorKind.FIELD_DECL, CursorKind.PARM_DECL)
+
+
+def clear():
+    deferred_declarations.clear()
+    deferred_names.clear()
+    failed_declarations.clear()
+
+
+def declaration_name(node: Cursor) -> str:
+    # Anonymous declarations assigned via a typedef have no spelling, use the type spelling instead (same as the
+    # handlers do when defining them).
+    return node.spelling or node.type.spelling
+
+
+def declaration_key(node: Cursor) -> str:
+    # Names are not unique (a typedef and a struct can share a name), so entries are keyed by the libclang USR.
+    # Fallback to the source location for declarations without a USR.
+    usr = node.get_usr()
+    if usr:
+        return usr
+    return f'{node.kind}@{node.location.file}:{node.location.line}:{node.location.column}'
+
+
+def is_deferrable(node: Cursor) -> bool:
+    # Anonymous types are never defined in the binaryView on their own, the enclosing declaration is deferred instead.
+    return bool(declaration_name(node)) and node.kind not in member_kinds and not node.is_anonymous()
+
+
+def is_deferred(node: Cursor) -> bool:
+    return declaration_key(node) in deferred_declarations
+
+
+def is_deferred_name(name: str) -> bool:
+    return deferred_names[name] > 0
+
+
+def canonical_declaration_name(node: Cursor) -> str:
+    # Name of the declaration behind all the typedefs of the node type.
+    # Example: typedef struct _A {...} A;  A a;
+    #          For 'a' (and for the typedef 'A' itself) returns '_A'.
+    return node.type.get_canonical().get_declaration().spelling
+
+
+def waits_on_deferred(node: Cursor) -> bool:
+    # Check if the type of the node is a type that is still deferred, either directly or through typedefs.
+    # The name of a member node is the name of the field\parameter, not of a type, so only its type is checked.
+    names = [node.type.spelling, node.type.get_declaration().spelling, canonical_declaration_name(node)]
+    if node.kind not in member_kinds:
+        names.append(node.spelling)
+    return any(name and is_deferred_name(name) for name in names)
+
+
+def is_defined(name: str, bv: bn.BinaryView) -> bool:
+    return isinstance(bv.get_type_by_name(name), bn.Type) and not is_deferred_name(name)
+
+
+def missing_dependencies(node: Cursor, bv: bn.BinaryView) -> List[str]:
+    # Collect the names of all types referenced by the declaration which are not yet defined in the binaryView.
+    # Example: typedef struct _A { struct _B *b; PC c; } A;
+    #          Will return ['_B', 'PC'] if both are not yet defined (or are still deferred).
+    missing = list()
+    for child in node.walk_preorder():
+        if child.kind != CursorKind.TYPE_REF:
+            continue
+        referenced = child.referenced
+        dependency_name = referenced.spelling if referenced else child.spelling
+        if not dependency_name or dependency_name == node.spelling or dependency_name in missing:
+            continue
+        if not is_defined(dependency_name, bv):
+            missing.append(dependency_name)
+    # A typedef of a struct defined inline has no TYPE_REF to the struct, depend on the struct through the typedef.
+    canonical_name = canonical_declaration_name(node)
+    if canonical_name and canonical_name != node.spelling and canonical_name not in missing and \
+            is_deferred_name(canonical_name):
+        missing.append(canonical_name)
+    return missing
+
+
+def add_entry(key: str, entry: Dict):
+    if key not in deferred_declarations:
+        deferred_names[entry['name']] += 1
+    deferred_declarations[key] = entry
+
+
+def remove_entry(key: str) -> Dict:
+    entry = deferred_declarations.pop(key)
+    deferred_names[entry['name']] -= 1
+    return entry
+
+
+def defer(node: Cursor, bv: bn.BinaryView, handler: Callable, error=None):
+    # Record a declaration that failed to be defined, along with the types it is missing, so that retry() can
+    # define it again later on using the same handler.
+    if not is_deferrable(node):
+        return
+    key = declaration_key(node)
+    previous = deferred_declarations.get(key)
+    add_entry(key, {
+        'name': declaration_name(node),
+        'node': node,
+        'handler': handler,
+        'missing': missing_dependencies(node, bv),
+        'error': str(error) if error is not None else '',
+        'attempts': previous['attempts'] + 1 if previous else 1
+    })
+    bn.log.log_debug(f'defer: Deferred {declaration_name(node)}, missing dependencies: '
+                     f'{deferred_declarations[key]["missing"]}')
+
+
+def is_ready(entry: Dict, bv: bn.BinaryView) -> bool:
+    # A declaration is ready to be retried once all the dependencies it was missing are defined (and not deferred).
+    # If no missing dependency could be determined it is always retried, since other declarations may have been
+    # defined in the meantime.
+    return all(is_defined(name, bv) for name in entry['missing'])
+
+
+def retry_entry(key: str, bv: bn.BinaryView) -> bool:
+    # Retry a single deferred declaration, returns True if it was defined.
+    # The entry is removed before retrying, the handler re-defers the declaration if it fails again.
+    entry = remove_entry(key)
+    try:
+        result = entry['handler'](entry['node'], bv)
+    except Exception as e:
+        result = None
+        defer(entry['node'], bv, entry['handler'], e)
+    if key in deferred_declarations:
+        deferred_declarations[key]['attempts'] = entry['attempts'] + 1
+        return False
+    if result is None:
+        # The handler failed without deferring the declaration itself, keep the original failure.
+        entry['attempts'] += 1
+        add_entry(key, entry)
+        return False
+    return True
+
+
+def retry(bv: bn.BinaryView, max_passes: int = MAX_RETRY_PASSES) -> Dict:
+    # Retry the deferred declarations until all of them are defined, no progress is made in a pass, or max_passes
+    # passes were done. Returns the failure report for the declarations that could not be defined.
+    for pass_number in range(1, max_passes + 1):
+        if not deferred_declarations:
+            break
+        pending = [key for key, entry in deferred_declarations.items() if is_ready(entry, bv)]
+        if not pending:
+            # Every declaration waits on another deferred declaration (e.g structs referencing each other), retry all
+            # of them since a dependency might not really be needed to define the declaration (e.g a pointer to it).
+            pending = list(deferred_declarations.keys())
+        queued = set(pending)
+        resolved_count = 0
+        while pending:
+            key = pending.pop(0)
+            if key not in deferred_declarations:
+                continue
+            name = deferred_declarations[key]['name']
+            if not retry_entry(key, bv):
+                continue
+            resolved_count += 1
+            bn.log.log_debug(f'retry: Successfully defined deferred declaration {name} on pass {pass_number}')
+            # Queue the declarations waiting on this one again, now that it is defined.
+            for dependent_key, dependent in deferred_declarations.items():
+                if dependent_key not in queued and name in dependent['missing'] and is_ready(dependent, bv):
+                    queued.add(dependent_key)
+                    pending.append(dependent_key)
+        bn.log.log_info(f'retry: Pass {pass_number} resolved {resolved_count} declarations, '
+                        f'{len(deferred_declarations)} remaining')
+        if not resolved_count:
+            break
+
+    for key, entry in deferred_declarations.items():
+        failed_declarations[key] = entry
+    deferred_declarations.clear()
+    deferred_names.clear()
+    return failure_report()
+
+
+def failed_declaration_names() -> Set[str]:
+    return {entry['name'] for entry in failed_declarations.values()}
+
+
+def failure_report() -> Dict:
+    # Machine readable report of the declarations that could not be defined.
+    return {
+        'failed_count': len(failed_declarations),
+        'failed': [
+            {
+                'name': entry['name'],
+                'key': key,
+                'handler': entry['handler'].__name__,
+                'kind': str(entry['node'].kind),
+                'missing': entry['missing'],
+                'error': entry['error'],
+                'attempts': entry['attempts']
+            }
+            for key, entry in sorted(failed_declarations.items(), key=lambda item: (item[1]['name'], item[0]))
+        ]
+    }
+
+
+def write_failure_report(path: str):
+    with open(path, 'w') as report_file:
+        json.dump(failure_report(), report_file, indent=4)
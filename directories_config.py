@@ -14,4 +14,17 @@ base_libraries_folder = 'C:\\Users\\rowr1\\AppData\Roaming\\Binary Ninja\plugins
 base_proccessed_header_folder = \
     'C:\\Users\\rowr1\\AppData\Roaming\\Binary Ninja\plugins\\PreProcess_headers\\Preproccessed_Typelibs\\'
 
-libclang_library_file = 'C:\\Program Files\\LLVM\\bin\\libclang.dll'
\ No newline at end of file
+libclang_library_file = 'C:\\Program Files\\LLVM\\bin\\libclang.dll'
+
+# Local cache of finished typelibs, see build_cache.py
+build_cache_folder = \
+    'C:\\Users\\rowr1\\AppData\Roaming\\Binary Ninja\plugins\\PreProcess_headers\\Build_Cache\\'
+
+# Maximum size in bytes of the build cache, least recently used entries are evicted once it is exceeded.
+build_cache_max_size = 1024 * 1024 * 1024
+
+# Address of the type query daemon, see type_query_daemon.py
+# The port is only used where Unix sockets are not available.
+type_query_socket = \
+    'C:\\Users\\rowr1\\AppData\Roaming\\Binary Ninja\plugins\\PreProcess_headers\\type_query.sock'
+type_query_port = 47201
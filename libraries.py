@@ -0,0 +1,35 @@
+import importlib
+import os
+from typing import *
+
+# Every sub directory of Libraries/ holds the config module of a single library (e.g Libraries/ntdll/ntdll_dll.py).
+# The config modules are only imported when a library is actually processed, so that loading the plugin does not
+# pay for them.
+libraries_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Libraries')
+
+# Keys are the library name (the name of its directory in Libraries/), the Value is the imported config module.
+loaded_libraries = dict()
+
+
+def discover_libraries() -> Dict[str, str]:
+    # Map each library name to the dotted name of its config module, without importing anything.
+    libraries = dict()
+    for library_name in sorted(os.listdir(libraries_folder)):
+        library_folder = os.path.join(libraries_folder, library_name)
+        if not os.path.isdir(library_folder):
+            continue
+        for file_name in sorted(os.listdir(library_folder)):
+            if file_name.endswith('.py') and not file_name.startswith('_'):
+                libraries[library_name] = f'.Libraries.{library_name}.{file_name[:-len(".py")]}'
+                break
+    return libraries
+
+
+def load_library(library_name: str):
+    # Import the config module of a library on first use.
+    if library_name not in loaded_libraries:
+        module_name = discover_libraries().get(library_name)
+        if module_name is None:
+            raise KeyError(f'load_library: No config module found for library {library_name} in {libraries_folder}')
+        loaded_libraries[library_name] = importlib.import_module(module_name, __package__)
+    return loaded_libraries[library_name]
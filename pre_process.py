@@ -1,9 +1,23 @@
 from clang.cindex import *
-from .Libraries.ws2_32 import ws2_32 as ws2
 import binaryninja as bn
-from .Libraries.ntdll import ntdll_dll as ntdll
 from . import directories_config
+from . import libraries
 from . import ast_handlers
+from . import deferred
+from . import build_cache
+from . import typelib_diff
+
+# Top level declarations which are retried when they fail to be defined.
+deferrable_kinds = (CursorKind.TYPEDEF_DECL, CursorKind.STRUCT_DECL, CursorKind.UNION_DECL, CursorKind.ENUM_DECL,
+                    CursorKind.VAR_DECL, CursorKind.FUNCTION_DECL)
+
+
+def retry_handler(node: Cursor):
+    # A failed struct may have left its empty forward decl placeholder in the binaryView, which define_type() would
+    # take as already defined, so structs are retried with struct_decl() directly.
+    if node.kind in (CursorKind.STRUCT_DECL, CursorKind.UNION_DECL):
+        return ast_handlers.struct_decl
+    return ast_handlers.define_type
 
 
 def pre_define_types(bv: bn.BinaryView, library):
@@ -21,6 +35,19 @@ def pre_define_types(bv: bn.BinaryView, library):
 
 
 def pp(bv: bn.BinaryView):
+    ntdll = libraries.load_library('ntdll')
+    typelib_file = directories_config.base_proccessed_header_folder + 'ntdll_type_lib.btl'
+    failure_report_file = directories_config.base_proccessed_header_folder + 'ntdll_failures.json'
+    manifest_file = directories_config.base_proccessed_header_folder + 'ntdll_type_lib.json'
+    # Keys are the artifact name inside the build cache, the Value is the path of the artifact.
+    build_outputs = {'type_lib.btl': typelib_file, 'failures.json': failure_report_file,
+                     'type_lib.json': manifest_file}
+
+    if build_cache.get(ntdll, build_outputs):
+        # Inputs did not change since a previous build, the typelib was restored without running libclang.
+        return
+
+    deferred.clear()
     pre_define_types(bv, ntdll)
 
     Config.set_library_file(directories_config.libclang_library_file)
@@ -32,19 +59,55 @@ def pp(bv: bn.BinaryView):
     for node in root_node.get_children():
         bn.log.log_debug(f'{"*" * 30}\nDEFINING NODE: \n {node.spelling} {node.type.spelling} \n'
                          f'node.kind: {node.kind}, node.type.kind: {node.type.kind}\n {"*" * 30}')
-        ast_handlers.define_type(node, bv)
+        try:
+            result = ast_handlers.define_type(node, bv)
+        except Exception as e:
+            # Handlers don't guard every binaryNinja call, e.g parsing a parameter type that is declared later on in
+            # the header raises a SyntaxError.
+            bn.log.log_debug(f'pp: Failed defining {node.spelling} with exception {e}')
+            deferred.defer(node, bv, retry_handler(node), e)
+            continue
+        if result is None and node.kind in deferrable_kinds and not deferred.is_deferred(node) and \
+                not (node.kind == CursorKind.FUNCTION_DECL and node.is_definition()):
+            # The declaration failed because a nested declaration failed (e.g a typedef of an anonymous struct whose
+            # field type is not yet defined), and no handler deferred it.
+            deferred.defer(node, bv, retry_handler(node))
+
+    # Retry the declarations that failed because they depend on types defined later on in the header.
+    deferred.retry(bv)
+    build_cache.break_hardlink(failure_report_file)
+    deferred.write_failure_report(failure_report_file)
 
     # Create the type lib from the parsed types
     ####################################################################
     ntdll_tl = bn.TypeLibrary.new(bn.Architecture["x86"], "ntdll.dll")
     ntdll_tl.add_platform(bn.Platform["windows-x86"])
 
+    failed_names = deferred.failed_declaration_names()
     for node in root_node.get_children():
         bn.log.log_debug(f'{"*" * 30}\nEXPORTING NODE: \n {node.spelling} {node.type.spelling} \n'
                          f'node.kind: {node.kind}, node.type.kind: {node.type.kind}\n {"*" * 30}')
+        if node.spelling in failed_names:
+            # Failed structs are only an empty forward decl placeholder in the binaryView, don't export them as a
+            # zero sized type (they are listed in the failure report).
+            bn.log.log_info(f'pp: Not exporting {node.spelling}, it failed to be defined.')
+            continue
         var_type = bv.get_type_by_name(node.spelling)
         if isinstance(var_type, bn.Type):
             bv.export_type_to_library(ntdll_tl, node.spelling, var_type)
     ntdll_tl.finalize()
-    ntdll_tl.write_to_file(directories_config.base_proccessed_header_folder + 'ntdll_type_lib.btl')
+    build_cache.break_hardlink(typelib_file)
+    ntdll_tl.write_to_file(typelib_file)
+    # Structural manifest of the typelib, used to diff it against other builds (see typelib_diff.py)
+    build_cache.break_hardlink(manifest_file)
+    try:
+        typelib_diff.write_manifest(typelib_file, manifest_file)
+    except Exception as e:
+        # The manifest is read from the .btl serialization, which binaryNinja doesn't document - don't let it fail the
+        # build (or keep it from being cached).
+        bn.log.log_error(f'pp: Failed writing the manifest of {typelib_file} with exception {e}')
+        typelib_diff.write_failed_manifest(manifest_file, e)
     ###################################################################
+
+    include_files = list(ntdll.header_list) + [include.include.name for include in tu.get_includes()]
+    build_cache.put(ntdll, include_files, build_outputs)
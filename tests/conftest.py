@@ -0,0 +1,45 @@
+import os
+import sys
+import types
+
+# The plugin modules are imported directly (not through the plugin package, whose __init__ registers the plugin
+# commands in Binary Ninja).
+plugin_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, plugin_folder)
+
+# The tests exercise the pure python logic with fake nodes and views, so they can run outside of Binary Ninja and
+# without libclang. Minimal fakes of those modules are used when they are not installed (pytest also imports the plugin
+# __init__, which only registers the plugin commands).
+try:
+    import binaryninja
+except ImportError:
+    binaryninja = types.ModuleType('binaryninja')
+    binaryninja.log = types.SimpleNamespace(log_debug=lambda *args: None, log_info=lambda *args: None,
+                                            log_error=lambda *args: None)
+    binaryninja.Type = type('Type', (), {})
+    binaryninja.TypeClass = types.SimpleNamespace(**{type_class: type_class for type_class in (
+        'IntegerTypeClass', 'StructureTypeClass', 'PointerTypeClass', 'ArrayTypeClass', 'FunctionTypeClass',
+        'NamedTypeReferenceClass')})
+    binaryninja.BinaryView = type('BinaryView', (), {})
+    binaryninja.TypeLibrary = type('TypeLibrary', (), {})
+    binaryninja.PluginCommand = types.SimpleNamespace(register=lambda *args: None)
+    sys.modules['binaryninja'] = binaryninja
+
+try:
+    import clang.cindex
+except ImportError:
+    clang = types.ModuleType('clang')
+    cindex = types.ModuleType('clang.cindex')
+    cindex.Cursor = type('Cursor', (), {})
+    cindex.CursorKind = types.SimpleNamespace(**{kind: kind for kind in (
+        'FIELD_DECL', 'PARM_DECL', 'TYPE_REF', 'STRUCT_DECL', 'TYPEDEF_DECL', 'FUNCTION_DECL')})
+    cindex.__all__ = ['Cursor', 'CursorKind']
+    clang.cindex = cindex
+    sys.modules['clang'] = clang
+    sys.modules['clang.cindex'] = cindex
+
+# Modules using relative imports (e.g build_cache, type_query_daemon) are imported through the plugin package, which is
+# registered without running its __init__.
+plugin_package = types.ModuleType('PreProcess_headers')
+plugin_package.__path__ = [plugin_folder]
+sys.modules['PreProcess_headers'] = plugin_package
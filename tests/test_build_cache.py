@@ -0,0 +1,154 @@
+import os
+import types
+
+import pytest
+
+from PreProcess_headers import build_cache
+from PreProcess_headers import directories_config
+
+
+def make_library(name='ntdll', header_file='ntdll.h'):
+    library = types.ModuleType(name)
+    library.header_list = [header_file]
+    library.pre_proccessor_args = ['-x', 'c++']
+    library.define_list = ['_AMD64_']
+    library.target_arch = 'x86_64'
+    library.pre_load_definition = {'unsigned int': 'ULONG'}
+    library.forward_declarations = {'struct': ['_PEB'], 'typedef': []}
+    return library
+
+
+@pytest.fixture(autouse=True)
+def cache_folder(tmp_path, monkeypatch):
+    folder = tmp_path / 'cache'
+    monkeypatch.setattr(directories_config, 'build_cache_folder', str(folder))
+    return folder
+
+
+@pytest.fixture
+def build(tmp_path):
+    # A finished build - the header it was built from and its output files.
+    header_file = tmp_path / 'ntdll.h'
+    header_file.write_text('typedef unsigned long ULONG;')
+    outputs = {'type_lib.btl': str(tmp_path / 'ntdll_type_lib.btl'), 'failures.json': str(tmp_path / 'failures.json')}
+    for name, path in outputs.items():
+        with open(path, 'w') as f:
+            f.write(f'{name} contents')
+    return types.SimpleNamespace(library=make_library(header_file=str(header_file)), header_file=header_file,
+                                 outputs=outputs)
+
+
+def read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('attribute, value', [
+    ('__name__', 'ws2_32'),
+    ('header_list', ['winsock2.h']),
+    ('pre_proccessor_args', ['-x', 'c']),
+    ('define_list', ['_X86_']),
+    ('target_arch', 'x86'),
+    ('pre_load_definition', {'unsigned short': 'USHORT'}),
+    ('forward_declarations', {'struct': ['_TEB'], 'typedef': []})
+])
+def test_manifest_key_depends_on_library_config(attribute, value):
+    library = make_library()
+    key = build_cache.manifest_key(library)
+    assert build_cache.manifest_key(make_library()) == key
+    setattr(library, attribute, value)
+    assert build_cache.manifest_key(library) != key
+
+
+def test_manifest_key_depends_on_code_version(monkeypatch):
+    key = build_cache.manifest_key(make_library())
+    monkeypatch.setattr(build_cache, 'code_version', lambda: 'changed')
+    assert build_cache.manifest_key(make_library()) != key
+
+
+def test_result_key_depends_on_include_chain(tmp_path):
+    first_header, second_header = tmp_path / 'a.h', tmp_path / 'b.h'
+    first_header.write_text('struct A;')
+    second_header.write_text('struct B;')
+    include_files = [str(first_header), str(second_header)]
+    key = build_cache.result_key('manifest', include_files)
+
+    assert build_cache.result_key('manifest', include_files) == key
+    assert build_cache.result_key('other manifest', include_files) != key
+    assert build_cache.result_key('manifest', include_files[:1]) != key
+    second_header.write_text('struct B {int b;};')
+    assert build_cache.result_key('manifest', include_files) != key
+    second_header.unlink()
+    assert build_cache.result_key('manifest', include_files) is None
+
+
+def test_get_and_put_round_trip(build):
+    assert not build_cache.get(build.library, build.outputs)
+    # A miss leaves the existing outputs in place.
+    assert read(build.outputs['type_lib.btl']) == 'type_lib.btl contents'
+
+    build_cache.put(build.library, [str(build.header_file)], build.outputs)
+    for path in build.outputs.values():
+        os.remove(path)
+    assert build_cache.get(build.library, build.outputs)
+
+    assert read(build.outputs['type_lib.btl']) == 'type_lib.btl contents'
+    assert read(build.outputs['failures.json']) == 'failures.json contents'
+    assert build_cache.stats() == {'hits': 1, 'misses': 1, 'stores': 1, 'evictions': 0}
+
+
+def test_changed_header_is_a_miss(build):
+    build_cache.put(build.library, [str(build.header_file)], build.outputs)
+    build.header_file.write_text('typedef unsigned short ULONG;')
+    assert not build_cache.get(build.library, build.outputs)
+
+
+def test_truncated_metadata_is_a_miss(build):
+    build_cache.put(build.library, [str(build.header_file)], build.outputs)
+    result_folder, = os.listdir(build_cache.cache_path(build_cache.RESULTS_FOLDER))
+    metadata_file = build_cache.cache_path(build_cache.RESULTS_FOLDER, result_folder, build_cache.METADATA_FILE)
+    with open(metadata_file, 'r+') as f:
+        f.truncate(10)
+    assert not build_cache.get(build.library, build.outputs)
+
+
+def test_break_hardlink_keeps_cached_artifact(build):
+    build_cache.put(build.library, [str(build.header_file)], build.outputs)
+    assert build_cache.get(build.library, build.outputs)
+    typelib_file = build.outputs['type_lib.btl']
+    assert os.stat(typelib_file).st_nlink > 1
+
+    build_cache.break_hardlink(typelib_file)
+    with open(typelib_file, 'w') as f:
+        f.write('rebuilt')
+    os.remove(build.outputs['failures.json'])
+    assert build_cache.get(build.library, build.outputs)
+    assert read(typelib_file) == 'type_lib.btl contents'
+
+
+def test_evict_removes_least_recently_used(tmp_path, build):
+    libraries = [make_library(name, str(build.header_file)) for name in ('first', 'second', 'third')]
+    for library in libraries:
+        build_cache.put(library, [str(build.header_file)], build.outputs)
+    results_folder = build_cache.cache_path(build_cache.RESULTS_FOLDER)
+    result_folders = dict()
+    for key in os.listdir(results_folder):
+        metadata = build_cache.read_json(os.path.join(results_folder, key, build_cache.METADATA_FILE))
+        result_folders[metadata['library']] = os.path.join(results_folder, key)
+    entry_size = build_cache.folder_size(result_folders['first'])
+    for last_used, name in enumerate(('second', 'first', 'third')):
+        os.utime(os.path.join(result_folders[name], build_cache.METADATA_FILE), (last_used, last_used))
+
+    build_cache.evict(entry_size * 2)
+
+    assert sorted(os.listdir(results_folder)) == sorted([os.path.basename(result_folders['first']),
+                                                        os.path.basename(result_folders['third'])])
+    assert build_cache.stats()['evictions'] == 1
+
+
+def test_write_json_leaves_no_temporary_files(cache_folder):
+    stats_file = build_cache.cache_path(build_cache.STATS_FILE)
+    build_cache.write_json(stats_file, {'hits': 1})
+    build_cache.update_stats(hits=2)
+    assert os.listdir(str(cache_folder)) == [build_cache.STATS_FILE]
+    assert build_cache.read_json(stats_file) == {'hits': 3}
@@ -0,0 +1,236 @@
+import types
+
+import binaryninja as bn
+import pytest
+from clang.cindex import CursorKind
+
+import deferred
+
+
+class FakeType(bn.Type):
+    # Passes the isinstance(..., bn.Type) checks without creating a real type (the real bn.Type requires a core
+    # handle).
+    def __init__(self):
+        pass
+
+    def __del__(self):
+        pass
+
+
+class FakeView:
+    def __init__(self, *names):
+        self.types = {name: FakeType() for name in names}
+
+    def get_type_by_name(self, name):
+        return self.types.get(name)
+
+    def define(self, name):
+        self.types[name] = FakeType()
+
+
+def fake_type(spelling, canonical=None):
+    # canonical is the name of the declaration behind the typedefs of the type (e.g '_A' for 'A' in
+    # typedef struct _A {...} A;).
+    return types.SimpleNamespace(spelling=spelling,
+                                 get_declaration=lambda: types.SimpleNamespace(spelling=spelling),
+                                 get_canonical=lambda: fake_type(canonical) if canonical else fake_type(spelling))
+
+
+class FakeNode:
+    def __init__(self, name, dependencies=(), kind=CursorKind.STRUCT_DECL, usr=None, canonical=None):
+        self.spelling = name
+        self.kind = kind
+        self.usr = usr if usr is not None else f'c:@S@{name}'
+        self.type = fake_type(name, canonical)
+        self.location = types.SimpleNamespace(file='test.h', line=1, column=1)
+        self.dependencies = dependencies
+
+    def get_usr(self):
+        return self.usr
+
+    def is_anonymous(self):
+        return False
+
+    def walk_preorder(self):
+        yield self
+        for dependency in self.dependencies:
+            yield types.SimpleNamespace(kind=CursorKind.TYPE_REF, spelling=dependency,
+                                        referenced=types.SimpleNamespace(spelling=dependency))
+
+
+def struct_handler(node, bv):
+    # Defines the node if all of its dependencies are defined, otherwise defers it (like struct_decl does).
+    for dependency in node.dependencies:
+        if not deferred.is_defined(dependency, bv):
+            deferred.defer(node, bv, struct_handler)
+            return
+    bv.define(node.spelling)
+    return node.spelling, bv.get_type_by_name(node.spelling)
+
+
+@pytest.fixture(autouse=True)
+def clear_deferred():
+    deferred.clear()
+    yield
+    deferred.clear()
+
+
+def test_retry_defines_declarations_once_dependencies_are_defined():
+    bv = FakeView()
+    node_a = FakeNode('_A', ['_B'])
+    node_b = FakeNode('_B', ['_C'])
+    struct_handler(node_a, bv)
+    struct_handler(node_b, bv)
+    assert deferred.deferred_declarations['c:@S@_A']['missing'] == ['_B']
+
+    bv.define('_C')
+    report = deferred.retry(bv)
+
+    assert report == {'failed_count': 0, 'failed': []}
+    assert '_A' in bv.types and '_B' in bv.types
+
+
+def test_placeholder_of_deferred_declaration_is_missing():
+    # struct_decl leaves an empty placeholder for a deferred struct in the view.
+    bv = FakeView('_B')
+    node_b = FakeNode('_B', ['_C'])
+    deferred.defer(node_b, bv, struct_handler)
+    node_a = FakeNode('_A', ['_B'])
+    deferred.defer(node_a, bv, struct_handler)
+
+    assert deferred.deferred_declarations['c:@S@_A']['missing'] == ['_B']
+    assert not deferred.is_ready(deferred.deferred_declarations['c:@S@_A'], bv)
+
+    bv.define('_C')
+    deferred.retry(bv)
+    assert not deferred.failed_declarations
+
+
+def test_dependents_are_queued_again_in_the_same_pass():
+    bv = FakeView()
+    for name, dependencies in (('_A', ['_B']), ('_B', ['_C']), ('_C', ['_D'])):
+        struct_handler(FakeNode(name, dependencies), bv)
+    bv.define('_D')
+    retried = list()
+    original_retry_entry = deferred.retry_entry
+
+    def counting_retry_entry(key, view):
+        retried.append(key)
+        return original_retry_entry(key, view)
+
+    deferred.retry_entry = counting_retry_entry
+    try:
+        deferred.retry(bv, max_passes=1)
+    finally:
+        deferred.retry_entry = original_retry_entry
+
+    assert retried == ['c:@S@_C', 'c:@S@_B', 'c:@S@_A']
+    assert not deferred.failed_declarations
+
+
+def test_unresolved_declaration_is_reported_with_attempts():
+    bv = FakeView()
+    struct_handler(FakeNode('_A', ['_MISSING']), bv)
+
+    report = deferred.retry(bv)
+
+    assert report['failed_count'] == 1
+    failure = report['failed'][0]
+    assert failure['name'] == '_A'
+    assert failure['key'] == 'c:@S@_A'
+    assert failure['handler'] == 'struct_handler'
+    assert failure['missing'] == ['_MISSING']
+    # Not ready since _MISSING is never defined, so all remaining declarations are retried once and the pass makes
+    # no progress.
+    assert failure['attempts'] == 2
+    assert not deferred.deferred_declarations and not deferred.deferred_names['_A']
+
+
+def test_handler_returning_none_without_deferring_keeps_original_failure():
+    bv = FakeView()
+    calls = list()
+
+    def failing_handler(node, view):
+        calls.append(node.spelling)
+
+    deferred.defer(FakeNode('_A'), bv, failing_handler, SyntaxError('unknown type'))
+    report = deferred.retry(bv, max_passes=5)
+
+    # The first pass makes no progress, so retry() stops instead of doing all passes.
+    assert calls == ['_A']
+    assert report['failed'][0]['error'] == 'unknown type'
+    assert report['failed'][0]['attempts'] == 2
+
+
+def test_handler_exception_re_defers_with_new_error():
+    bv = FakeView()
+
+    def raising_handler(node, view):
+        raise ValueError('parse failed')
+
+    deferred.defer(FakeNode('_A'), bv, raising_handler, 'first error')
+    report = deferred.retry(bv)
+
+    assert report['failed'][0]['error'] == 'parse failed'
+    assert report['failed'][0]['attempts'] == 2
+
+
+def test_retry_is_bounded_by_max_passes():
+    bv = FakeView()
+    calls = list()
+
+    def progress_handler(node, view):
+        # Every attempt defers a new declaration, so every pass makes progress.
+        calls.append(node.spelling)
+        deferred.defer(FakeNode(node.spelling + '_'), view, progress_handler)
+        return node.spelling, FakeType()
+
+    deferred.defer(FakeNode('_A'), bv, progress_handler)
+    report = deferred.retry(bv, max_passes=3)
+
+    assert calls == ['_A', '_A_', '_A__']
+    assert [failure['name'] for failure in report['failed']] == ['_A___']
+
+
+def test_members_are_not_deferred():
+    bv = FakeView()
+    deferred.defer(FakeNode('Buffer', ['_B'], kind=CursorKind.FIELD_DECL), bv, struct_handler)
+    deferred.defer(FakeNode('Reserved', ['_B'], kind=CursorKind.PARM_DECL), bv, struct_handler)
+    assert not deferred.deferred_declarations
+
+
+def test_declarations_with_the_same_name_do_not_overwrite_each_other():
+    bv = FakeView()
+    deferred.defer(FakeNode('A', ['_B'], kind=CursorKind.STRUCT_DECL, usr='c:@S@A'), bv, struct_handler)
+    deferred.defer(FakeNode('A', ['_C'], kind=CursorKind.TYPEDEF_DECL, usr='c:@T@A'), bv, struct_handler)
+
+    assert set(deferred.deferred_declarations) == {'c:@S@A', 'c:@T@A'}
+    assert deferred.is_deferred_name('A')
+
+    bv.define('_B')
+    deferred.retry(bv)
+    assert list(deferred.failed_declarations) == ['c:@T@A']
+
+
+def test_typedef_of_deferred_struct_waits_on_it():
+    # typedef struct _A { struct _B *b; } A;
+    bv = FakeView()
+    struct_handler(FakeNode('_A', ['_B']), bv)
+    typedef_node = FakeNode('A', kind=CursorKind.TYPEDEF_DECL, usr='c:@T@A', canonical='_A')
+    field_node = FakeNode('a', kind=CursorKind.FIELD_DECL, canonical='_A')
+
+    assert deferred.waits_on_deferred(typedef_node)
+    assert deferred.waits_on_deferred(field_node)
+
+    def typedef_handler(node, view):
+        # Like define_type, doesn't define a node while its type is deferred.
+        if deferred.waits_on_deferred(node):
+            return
+        view.define(node.spelling)
+        return node.spelling, view.get_type_by_name(node.spelling)
+
+    deferred.defer(typedef_node, bv, typedef_handler)
+    assert deferred.deferred_declarations['c:@T@A']['missing'] == ['_A']
+
+    deferred.retry(bv)
+    assert deferred.failed_declaration_names() == {'A', '_A'}
@@ -0,0 +1,169 @@
+import os
+import types
+
+import binaryninja as bn
+import pytest
+
+from PreProcess_headers import build_cache
+from PreProcess_headers import directories_config
+from PreProcess_headers import type_query_daemon
+
+
+def fake_type(type_class=bn.TypeClass.IntegerTypeClass, width=4, **attributes):
+    return types.SimpleNamespace(type_class=type_class, width=width, get_string_before_name=lambda: 'T',
+                                 get_string_after_name=lambda: '', **attributes)
+
+
+def named_reference(name):
+    return fake_type(bn.TypeClass.NamedTypeReferenceClass,
+                     named_type_reference=types.SimpleNamespace(name=name))
+
+
+class FakeTypeLibrary:
+    def __init__(self, named_types):
+        self.named_types = named_types
+
+    def get_named_type(self, name):
+        return self.named_types.get(name)
+
+
+# Keys are the .btl file name, the Value is the named types of the typelib loaded from it.
+libraries = {
+    'ntdll_type_lib.btl': {
+        'ULONG': fake_type(),
+        'UNICODE_STRING': fake_type(bn.TypeClass.StructureTypeClass, width=16, structure=types.SimpleNamespace(
+            members=[types.SimpleNamespace(type=named_reference('USHORT')),
+                     types.SimpleNamespace(type=fake_type(bn.TypeClass.PointerTypeClass, width=8,
+                                                          target=named_reference('WCHAR')))])),
+        'USHORT': fake_type(width=2),
+        'WCHAR': fake_type(width=2)
+    },
+    'ws2_32_type_lib.btl': {
+        'WSADATA': fake_type(width=408),
+        'WSAPROTOCOL_INFOW': fake_type(width=628)
+    }
+}
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    # Names of the .btl files loaded, in order.
+    loaded = list()
+
+    def load_from_file(path):
+        loaded.append(os.path.basename(path))
+        return FakeTypeLibrary(libraries[os.path.basename(path)])
+
+    monkeypatch.setattr(bn, 'TypeLibrary', types.SimpleNamespace(load_from_file=load_from_file))
+    return loaded
+
+
+@pytest.fixture
+def cache(tmp_path, loads, monkeypatch):
+    monkeypatch.setattr(directories_config, 'build_cache_folder', str(tmp_path / 'cache'))
+    typelib_folder = tmp_path / 'typelibs'
+    typelib_folder.mkdir()
+    for file_name in libraries:
+        (typelib_folder / file_name).write_bytes(b'BNTL')
+    return type_query_daemon.TypeLibraryCache(str(typelib_folder))
+
+
+def test_libraries_and_unknown_op(cache):
+    assert type_query_daemon.handle_request(cache, {'op': 'libraries'})['result'] == ['ntdll', 'ws2_32']
+    assert type_query_daemon.handle_request(cache, {'op': 'drop'})['error'] == 'Unknown op drop'
+
+
+def test_type_query_searches_all_libraries(cache, loads):
+    response = type_query_daemon.handle_request(cache, {'op': 'type', 'name': 'WSADATA'})
+    assert response['library'] == 'ws2_32' and not response['stale']
+    assert response['result'] == {'name': 'WSADATA', 'type_class': str(bn.TypeClass.IntegerTypeClass),
+                                  'width': 408, 'declaration': 'T WSADATA'}
+
+    missing = type_query_daemon.handle_request(cache, {'op': 'type', 'name': 'MISSING', 'library': 'ntdll'})
+    assert missing == {'op': 'type', 'name': 'MISSING', 'error': 'MISSING not found'}
+    assert loads == ['ntdll_type_lib.btl', 'ws2_32_type_lib.btl']
+
+
+def test_prefix_query(cache, monkeypatch):
+    response = type_query_daemon.handle_request(cache, {'op': 'prefix', 'name': 'U'})
+    assert [result['name'] for result in response['result']] == ['ULONG', 'UNICODE_STRING', 'USHORT']
+
+    monkeypatch.setattr(type_query_daemon, 'MAX_PREFIX_RESULTS', 2)
+    response = type_query_daemon.handle_request(cache, {'op': 'prefix', 'name': 'W', 'library': 'ws2_32'})
+    assert [result['name'] for result in response['result']] == ['WSADATA', 'WSAPROTOCOL_INFOW']
+    # WCHAR of ntdll sorts before the ws2_32 types, prefix results are per library.
+    response = type_query_daemon.handle_request(cache, {'op': 'prefix', 'name': 'W'})
+    assert response['library'] == 'ntdll' and [result['name'] for result in response['result']] == ['WCHAR']
+
+
+def test_empty_prefix_result_is_not_an_error(cache):
+    response = type_query_daemon.handle_request(cache, {'op': 'prefix', 'name': 'ZZ', 'library': 'ntdll'})
+    assert response['library'] == 'ntdll' and response['result'] == []
+    response = type_query_daemon.handle_request(cache, {'op': 'prefix', 'name': 'WSA'})
+    assert response['library'] == 'ws2_32' and len(response['result']) == 2
+
+
+def test_closure_query(cache):
+    response = type_query_daemon.handle_request(cache, {'op': 'closure', 'name': 'UNICODE_STRING'})
+    assert [result['name'] for result in response['result']] == ['UNICODE_STRING', 'WCHAR', 'USHORT']
+
+
+def test_results_are_bounded_lru(cache, monkeypatch):
+    monkeypatch.setattr(type_query_daemon, 'MAX_CACHED_RESULTS', 2)
+    for name in ('ULONG', 'USHORT', 'ULONG', 'WCHAR'):
+        type_query_daemon.handle_request(cache, {'op': 'type', 'name': name, 'library': 'ntdll'})
+    assert list(cache.results['ntdll']) == [('type', 'ULONG'), ('type', 'WCHAR')]
+
+
+def test_changed_typelib_is_reloaded(cache, loads):
+    type_query_daemon.handle_request(cache, {'op': 'type', 'name': 'ULONG', 'library': 'ntdll'})
+    cache.check_for_changes()
+    assert 'ntdll' in cache.typelibs
+
+    typelib_file = cache.typelib_file('ntdll')
+    os.utime(typelib_file, (os.path.getmtime(typelib_file) + 10,) * 2)
+    cache.check_for_changes()
+    assert 'ntdll' not in cache.typelibs and 'ntdll' not in cache.results
+
+    type_query_daemon.handle_request(cache, {'op': 'type', 'name': 'ULONG', 'library': 'ntdll'})
+    assert loads == ['ntdll_type_lib.btl', 'ntdll_type_lib.btl']
+
+
+def test_changed_include_file_marks_typelib_stale(cache, tmp_path):
+    header_file = tmp_path / 'ntdll.h'
+    header_file.write_text('typedef unsigned long ULONG;')
+    typelib_file = cache.typelib_file('ntdll')
+    os.utime(str(header_file), (os.path.getmtime(typelib_file) - 10,) * 2)
+    build_cache.write_json(build_cache.cache_path(build_cache.MANIFESTS_FOLDER, 'key.json'),
+                           {'include_files': [str(header_file)], 'outputs': {'type_lib.btl': typelib_file}})
+
+    type_query_daemon.handle_request(cache, {'op': 'type', 'name': 'ULONG', 'library': 'ntdll'})
+    cache.check_for_changes()
+    assert not cache.stale
+
+    os.utime(str(header_file), (os.path.getmtime(typelib_file) + 10,) * 2)
+    cache.check_for_changes()
+    response = type_query_daemon.handle_request(cache, {'op': 'type', 'name': 'ULONG', 'library': 'ntdll'})
+    assert response['stale']
+
+
+def test_batches_and_pipelined_requests(cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(directories_config, 'type_query_socket', str(tmp_path / 'type_query.sock'))
+    server = type_query_daemon.serve(cache.typelib_folder)
+    try:
+        assert type_query_daemon.serve(cache.typelib_folder) is server
+        responses = type_query_daemon.query([
+            {'op': 'type', 'name': 'ULONG'},
+            [{'op': 'type', 'name': 'WSADATA'}, {'op': 'prefix', 'name': 'US'}],
+            'not a request',
+            {'op': 'type', 'name': 'MISSING'}
+        ])
+    finally:
+        type_query_daemon.stop()
+
+    assert responses[0]['result']['name'] == 'ULONG'
+    assert [response['library'] for response in responses[1]] == ['ws2_32', 'ntdll']
+    assert [result['name'] for result in responses[1][1]['result']] == ['USHORT']
+    assert 'error' in responses[2]
+    assert responses[3]['error'] == 'MISSING not found'
+    assert type_query_daemon.running_server is None
@@ -0,0 +1,81 @@
+import copy
+import os
+
+import pytest
+
+import typelib_diff
+
+typelibs_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Preproccessed_Typelibs')
+
+
+@pytest.fixture(scope='module')
+def ws2_32_typelib():
+    return typelib_diff.read_typelib(os.path.join(typelibs_folder, 'ws2_32_type_lib.btl'))
+
+
+def find_type(typelib, name):
+    return next(named_type for named_type in typelib['types'] if named_type['name'] == [name])
+
+
+def test_lzf_decompress_literals_and_overlapping_references():
+    # 'ab' as literals, then a back reference of length 6 at offset 2, which overlaps the bytes it produces.
+    assert typelib_diff.lzf_decompress(bytes([1]) + b'ab' + bytes([4 << 5, 1]), 8) == b'abababab'
+
+
+def test_lzf_decompress_rejects_wrong_size():
+    with pytest.raises(ValueError):
+        typelib_diff.lzf_decompress(bytes([1]) + b'ab', 3)
+
+
+def test_read_typelib(ws2_32_typelib):
+    assert ws2_32_typelib['name'] == 'ws2_32.dll'
+    signature = typelib_diff.type_signature(find_type(ws2_32_typelib, 'AsyncIMultiQIVtbl')['type'])
+    assert signature['kind'] == 'struct'
+    assert signature['fields'][0]['name'] == 'QueryInterface'
+    assert signature['fields'][0]['type'] == 'HRESULT (struct IRpcChannelBuffer *, const IID * const, void * *) *'
+
+
+def test_diff_of_identical_builds_is_empty(ws2_32_typelib):
+    manifest = typelib_diff.build_manifest(ws2_32_typelib)
+    assert typelib_diff.diff(manifest, manifest) == {'added': [], 'removed': [], 'changed': {}}
+
+
+def test_diff_reports_added_removed_and_changed_fields(ws2_32_typelib):
+    new_typelib = copy.deepcopy(ws2_32_typelib)
+    new_typelib['types'] = [named_type for named_type in new_typelib['types'] if named_type['name'] != ['ALG_ID']]
+    new_typelib['types'].append({'name': ['NEW_TYPE'], 'type': find_type(ws2_32_typelib, 'DATE')['type']})
+    structure = find_type(new_typelib, 'AsyncIMultiQIVtbl')['type']['struct']
+    structure['width'] += 8
+    structure['members'][1]['offset'] += 8
+    del structure['members'][2]
+
+    report = typelib_diff.diff(typelib_diff.build_manifest(ws2_32_typelib), typelib_diff.build_manifest(new_typelib))
+
+    assert report['added'] == ['NEW_TYPE']
+    assert report['removed'] == ['ALG_ID']
+    assert list(report['changed']) == ['AsyncIMultiQIVtbl']
+    details = report['changed']['AsyncIMultiQIVtbl']
+    assert details['width']['new'] == details['width']['old'] + 8
+    assert [field['name'] for field in details['fields']['removed']] == ['Release']
+    assert [change['new']['offset'] - change['old']['offset'] for change in details['fields']['changed']] == [8]
+
+
+def test_manifest_round_trip(tmp_path):
+    typelib_file = os.path.join(typelibs_folder, 'ntdll_type_lib.btl')
+    manifest_file = str(tmp_path / 'ntdll_type_lib.json')
+    typelib_diff.write_manifest(typelib_file, manifest_file)
+    assert typelib_diff.diff_files(typelib_file, manifest_file) == {'added': [], 'removed': [], 'changed': {}}
+
+
+def test_unreadable_typelib_leaves_no_manifest_and_failed_manifest_raises(tmp_path):
+    typelib_file = str(tmp_path / 'broken_type_lib.btl')
+    manifest_file = str(tmp_path / 'broken_type_lib.json')
+    with open(typelib_file, 'wb') as f:
+        f.write(b'NOPE')
+    with pytest.raises(ValueError) as error:
+        typelib_diff.write_manifest(typelib_file, manifest_file)
+    assert not os.path.exists(manifest_file)
+
+    typelib_diff.write_failed_manifest(manifest_file, error.value)
+    with pytest.raises(ValueError, match='could not be read'):
+        typelib_diff.load_manifest(manifest_file)
@@ -0,0 +1,344 @@
+import binaryninja as bn
+from typing import *
+from collections import OrderedDict
+import bisect
+import json
+import os
+import socket
+import socketserver
+import threading
+from . import directories_config
+from . import build_cache
+
+# A long running local service answering type queries from the processed typelibs, so that scripts don't have to
+# parse the headers or load a typelib on every invocation.
+# The typelibs and the resolved query results are kept in memory, and are invalidated when the .btl file changes on
+# disk (e.g after a rebuild). A typelib whose include chain (as recorded by the build cache) changed after it was built
+# is reported as stale.
+#
+# Protocol: newline delimited JSON over a Unix socket (or a localhost TCP port where Unix sockets are not available).
+# Every request line is either a single request or a list of requests (a batch), and gets a single response line in
+# the same order, so clients can pipeline many lines without waiting for the responses.
+# Request: {"op": "type" | "prefix" | "closure" | "libraries", "name": <type name or prefix>, "library": <optional>}
+# Example: {"op": "closure", "name": "WSAPROTOCOL_INFOW", "library": "ws2_32"}
+
+TYPELIB_SUFFIX = '_type_lib.btl'
+
+# Maximum number of types returned for a prefix query.
+MAX_PREFIX_RESULTS = 1000
+
+# Maximum number of query results kept per library, the least recently used results are dropped first.
+MAX_CACHED_RESULTS = 4096
+
+# Interval in seconds between checks of the typelibs and headers on disk.
+WATCH_INTERVAL = 2.0
+
+
+class TypeLibraryCache:
+    def __init__(self, typelib_folder: str):
+        self.typelib_folder = typelib_folder
+        self.lock = threading.Lock()
+        # Keys are the library name (e.g ntdll), the Value is a tuple of the .btl mtime, the loaded TypeLibrary and the
+        # sorted names of its types (used to answer prefix queries).
+        self.typelibs = dict()
+        # Keys are the library name, the Value is an OrderedDict of query results for that library, in LRU order.
+        self.results = dict()
+        # Libraries whose include chain changed on disk since their typelib was built.
+        self.stale = set()
+        # Set when the daemon is stopped, ends the watch() thread.
+        self.stopped = threading.Event()
+
+    def library_names(self) -> List[str]:
+        return sorted(file_name[:-len(TYPELIB_SUFFIX)] for file_name in os.listdir(self.typelib_folder)
+                      if file_name.endswith(TYPELIB_SUFFIX))
+
+    def typelib_file(self, library_name: str) -> str:
+        return os.path.join(self.typelib_folder, library_name + TYPELIB_SUFFIX)
+
+    def get_typelib(self, library_name: str) -> Optional[Tuple[bn.TypeLibrary, List[str]]]:
+        # Load the typelib on first use, and reload it if the .btl file changed since it was loaded.
+        # Returns the typelib along with the sorted names of its types.
+        typelib_file = self.typelib_file(library_name)
+        if not os.path.isfile(typelib_file):
+            return None
+        mtime = os.path.getmtime(typelib_file)
+        with self.lock:
+            cached = self.typelibs.get(library_name)
+            if cached is None or cached[0] != mtime:
+                bn.log.log_info(f'type_query_daemon: Loading {typelib_file}')
+                typelib = bn.TypeLibrary.load_from_file(typelib_file)
+                names = sorted(str(name) for name in typelib.named_types.keys())
+                self.typelibs[library_name] = (mtime, typelib, names)
+                self.results[library_name] = OrderedDict()
+            return self.typelibs[library_name][1:]
+
+    def include_files(self, library_name: str) -> List[str]:
+        # The include chain of the typelib, as recorded by the build cache when it was built.
+        typelib_file = os.path.normcase(os.path.abspath(self.typelib_file(library_name)))
+        manifests_folder = build_cache.cache_path(build_cache.MANIFESTS_FOLDER)
+        if not os.path.isdir(manifests_folder):
+            return list()
+        for manifest_file in os.listdir(manifests_folder):
+            manifest = build_cache.read_json(os.path.join(manifests_folder, manifest_file))
+            if not manifest:
+                continue
+            outputs = [os.path.normcase(os.path.abspath(output)) for output in manifest.get('outputs', {}).values()]
+            if typelib_file in outputs:
+                return manifest['include_files']
+        return list()
+
+    def check_for_changes(self):
+        # Drop the typelibs whose .btl changed on disk (they are reloaded on the next query), and mark as stale the
+        # typelibs whose include chain changed after they were built.
+        with self.lock:
+            loaded_libraries = list(self.typelibs.items())
+        for library_name, (mtime, typelib, names) in loaded_libraries:
+            typelib_file = self.typelib_file(library_name)
+            if not os.path.isfile(typelib_file) or os.path.getmtime(typelib_file) != mtime:
+                bn.log.log_info(f'type_query_daemon: {typelib_file} changed, invalidating.')
+                with self.lock:
+                    self.typelibs.pop(library_name, None)
+                    self.results.pop(library_name, None)
+                    self.stale.discard(library_name)
+                continue
+            for include_file in self.include_files(library_name):
+                if not os.path.exists(include_file) or os.path.getmtime(include_file) > mtime:
+                    bn.log.log_info(f'type_query_daemon: {include_file} changed, {library_name} is stale.')
+                    self.stale.add(library_name)
+                    break
+
+    def watch(self, interval: float):
+        while not self.stopped.wait(interval):
+            try:
+                self.check_for_changes()
+            except Exception as e:
+                bn.log.log_debug(f'type_query_daemon: Failed checking for changes with exception {e}')
+
+    def cached_result(self, library_name: str, key: Tuple, compute: Callable):
+        # compute is called with the typelib and the sorted names of its types.
+        loaded = self.get_typelib(library_name)
+        if loaded is None:
+            return None
+        with self.lock:
+            library_results = self.results.setdefault(library_name, OrderedDict())
+            if key in library_results:
+                library_results.move_to_end(key)
+                return library_results[key]
+        result = compute(*loaded)
+        with self.lock:
+            library_results[key] = result
+            if len(library_results) > MAX_CACHED_RESULTS:
+                library_results.popitem(last=False)
+        return result
+
+
+def describe_type(name: str, var_type: bn.Type) -> Dict:
+    return {
+        'name': name,
+        'type_class': str(var_type.type_class),
+        'width': var_type.width,
+        'declaration': var_type.get_string_before_name() + ' ' + name + var_type.get_string_after_name()
+    }
+
+
+def referenced_type_names(var_type: bn.Type) -> List[str]:
+    # Collect the names of all named types directly referenced by the type (struct members, pointer targets, array
+    # elements, function return value and parameters).
+    names = list()
+    pending = [var_type]
+    while pending:
+        current_type = pending.pop()
+        if current_type is None:
+            continue
+        if current_type.type_class == bn.TypeClass.NamedTypeReferenceClass:
+            names.append(str(current_type.named_type_reference.name))
+        elif current_type.type_class == bn.TypeClass.StructureTypeClass:
+            pending.extend(member.type for member in current_type.structure.members)
+        elif current_type.type_class == bn.TypeClass.PointerTypeClass:
+            pending.append(current_type.target)
+        elif current_type.type_class == bn.TypeClass.ArrayTypeClass:
+            pending.append(current_type.element_type)
+        elif current_type.type_class == bn.TypeClass.FunctionTypeClass:
+            pending.append(current_type.return_value)
+            pending.extend(parameter.type for parameter in current_type.parameters)
+    return names
+
+
+def query_type(typelib: bn.TypeLibrary, names: List[str], name: str) -> Optional[Dict]:
+    var_type = typelib.get_named_type(name)
+    if var_type is None:
+        return None
+    return describe_type(name, var_type)
+
+
+def query_prefix(typelib: bn.TypeLibrary, names: List[str], prefix: str) -> List[Dict]:
+    # names is sorted, so the names starting with the prefix are a contiguous range starting at its insertion point.
+    results = list()
+    for index in range(bisect.bisect_left(names, prefix), len(names)):
+        name = names[index]
+        if not name.startswith(prefix) or len(results) == MAX_PREFIX_RESULTS:
+            break
+        results.append(describe_type(name, typelib.get_named_type(name)))
+    return results
+
+
+def query_closure(typelib: bn.TypeLibrary, names: List[str], name: str) -> Optional[List[Dict]]:
+    # The type along with every type it depends on, recursively.
+    if typelib.get_named_type(name) is None:
+        return None
+    closure = list()
+    visited = {name}
+    pending = [name]
+    while pending:
+        current_name = pending.pop(0)
+        var_type = typelib.get_named_type(current_name)
+        if var_type is None:
+            # Referenced type is not part of this typelib (e.g a binaryNinja builtin).
+            continue
+        closure.append(describe_type(current_name, var_type))
+        for referenced_name in referenced_type_names(var_type):
+            if referenced_name not in visited:
+                visited.add(referenced_name)
+                pending.append(referenced_name)
+    return closure
+
+
+query_handlers = {
+    'type': query_type,
+    'prefix': query_prefix,
+    'closure': query_closure
+}
+
+
+def handle_request(cache: TypeLibraryCache, request: Dict) -> Dict:
+    op = request.get('op')
+    if op == 'libraries':
+        return {'op': op, 'result': cache.library_names()}
+    if op not in query_handlers:
+        return {'op': op, 'error': f'Unknown op {op}'}
+
+    name = request.get('name', '')
+    library_names = [request['library']] if request.get('library') else cache.library_names()
+    empty_response = None
+    for library_name in library_names:
+        result = cache.cached_result(library_name, (op, name),
+                                     lambda typelib, names: query_handlers[op](typelib, names, name))
+        if result is None:
+            continue
+        response = {'op': op, 'name': name, 'library': library_name, 'stale': library_name in cache.stale,
+                    'result': result}
+        if result:
+            return response
+        # An empty prefix result is a valid answer, but another library may have matching types.
+        empty_response = empty_response or response
+    return empty_response or {'op': op, 'name': name, 'error': f'{name} not found'}
+
+
+class TypeQueryHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if isinstance(request, list):
+                    response = [handle_request(self.server.cache, r) for r in request]
+                else:
+                    response = handle_request(self.server.cache, request)
+            except Exception as e:
+                bn.log.log_debug(f'type_query_daemon: Failed handling request {line} with exception {e}')
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class TypeQueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+else:
+    # Unix sockets are not available on older versions of Windows, fallback to a localhost TCP port.
+    # allow_reuse_address is left off, on Windows it would let a second daemon take over the port of a running one.
+    class TypeQueryServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+        daemon_threads = True
+
+
+# The daemon running in this process, serve() returns it instead of starting a second one.
+running_server = None
+running_server_lock = threading.Lock()
+
+
+def server_address():
+    if hasattr(socket, 'AF_UNIX'):
+        return directories_config.type_query_socket
+    return '127.0.0.1', directories_config.type_query_port
+
+
+def is_listening(address) -> bool:
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(address)
+            return True
+        except OSError:
+            return False
+
+
+def serve(typelib_folder: str = directories_config.base_proccessed_header_folder) -> Optional[TypeQueryServer]:
+    # Start the daemon in a background thread and return the server (call stop() to stop it).
+    # Returns the running server if the daemon was already started in this process, and None if another process is
+    # already listening on the daemon address.
+    global running_server
+    with running_server_lock:
+        if running_server is not None:
+            bn.log.log_info('type_query_daemon: Already running.')
+            return running_server
+
+        address = server_address()
+        if is_listening(address):
+            bn.log.log_error(f'type_query_daemon: Another daemon is already listening on {address}')
+            return None
+        if isinstance(address, str) and os.path.exists(address):
+            # Nothing is listening on it, this is a leftover socket file of a daemon that was not stopped.
+            os.remove(address)
+        try:
+            server = TypeQueryServer(address, TypeQueryHandler)
+        except OSError as e:
+            bn.log.log_error(f'type_query_daemon: Failed listening on {address} with exception {e}')
+            return None
+
+        server.cache = TypeLibraryCache(typelib_folder)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        threading.Thread(target=server.cache.watch, args=(WATCH_INTERVAL,), daemon=True).start()
+        bn.log.log_info(f'type_query_daemon: Listening on {address}')
+        running_server = server
+        return server
+
+
+def stop():
+    global running_server
+    with running_server_lock:
+        if running_server is None:
+            return
+        running_server.shutdown()
+        running_server.server_close()
+        running_server.cache.stopped.set()
+        address = server_address()
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+        running_server = None
+
+
+def query(requests: List[Dict]) -> List[Dict]:
+    # Client side helper, pipelines all requests over a single connection and returns the responses in order.
+    address = server_address()
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as client:
+        client.connect(address)
+        # Send from a separate thread, otherwise a big batch could fill both socket buffers and deadlock.
+        request_lines = b''.join(json.dumps(request).encode() + b'\n' for request in requests)
+        sender = threading.Thread(target=client.sendall, args=(request_lines,), daemon=True)
+        sender.start()
+        with client.makefile('rb') as responses:
+            results = [json.loads(responses.readline()) for _ in requests]
+        sender.join()
+        return results
@@ -0,0 +1,251 @@
+from typing import *
+import json
+import struct
+import xxhash
+
+# Structural diff between two builds of the same typelib.
+# Every named type of a typelib is reduced to a structural signature (kind, size, fields and offsets, parameters, enum
+# members) and a hash of that signature. Referenced types are recorded by name only, so a change to a type only changes
+# its own hash and the diff stays linear in the number of types.
+# The signatures are computed directly from the .btl contents, without loading the typelib into binaryNinja:
+# a .btl file is the 'BNTL' magic, the uncompressed size (uint32, little endian) and the LZF compressed JSON
+# serialization of the typelib. The signatures of a build are also written next to the .btl as a manifest, so a diff
+# against that build doesn't even need to decompress it.
+
+MANIFEST_VERSION = 2
+
+BTL_MAGIC = b'BNTL'
+BTL_HEADER_SIZE = 8
+
+# Values of the 'type' field of a serialized structure.
+structure_types = {0: 'class', 1: 'struct', 2: 'union'}
+
+
+def lzf_decompress(data: bytes, size: int) -> bytes:
+    # Decompress liblzf data. Each chunk starts with a control byte:
+    #   ctrl < 32 - a run of ctrl + 1 literal bytes follows.
+    #   otherwise - a back reference. The top 3 bits are the length - 2 (7 means an extra length byte follows), the low
+    #               5 bits and the next byte are the offset - 1 back into the output.
+    output = bytearray()
+    index = 0
+    while index < len(data):
+        ctrl = data[index]
+        index += 1
+        if ctrl < 32:
+            output += data[index:index + ctrl + 1]
+            index += ctrl + 1
+            continue
+        length = ctrl >> 5
+        if length == 7:
+            length += data[index]
+            index += 1
+        length += 2
+        reference = len(output) - ((ctrl & 0x1f) << 8) - data[index] - 1
+        index += 1
+        if reference < 0:
+            raise ValueError('lzf_decompress: Back reference before the start of the output')
+        if reference + length <= len(output):
+            output += output[reference:reference + length]
+        else:
+            # The reference overlaps the bytes it produces (e.g a run of the same byte), copy byte by byte.
+            for offset in range(length):
+                output.append(output[reference + offset])
+    if len(output) != size:
+        raise ValueError(f'lzf_decompress: Decompressed {len(output)} bytes, expected {size}')
+    return bytes(output)
+
+
+def read_typelib(typelib_file: str) -> Dict:
+    # Read the JSON serialization of a typelib from a .btl file.
+    with open(typelib_file, 'rb') as f:
+        data = f.read()
+    if data[:len(BTL_MAGIC)] != BTL_MAGIC:
+        raise ValueError(f'read_typelib: {typelib_file} is not a type library')
+    size, = struct.unpack('<I', data[len(BTL_MAGIC):BTL_HEADER_SIZE])
+    return json.loads(lzf_decompress(data[BTL_HEADER_SIZE:], size))
+
+
+def qualified_name(name: List[str]) -> str:
+    return '::'.join(name)
+
+
+def render_type(var_type: Dict) -> str:
+    # Compact C like spelling of a serialized type, used for fields, parameters and other referenced types.
+    kind = var_type['type']
+    if kind == 'name':
+        name = var_type['name']
+        if name['type'] == 'typedef':
+            spelling = qualified_name(name['name'])
+        else:
+            spelling = f'{name["type"]} {qualified_name(name["name"])}'
+    elif kind == 'ptr':
+        spelling = render_type(var_type['ref']) + ' *'
+    elif kind == 'array':
+        spelling = f'{render_type(var_type["element"])}[{var_type["count"]}]'
+    elif kind == 'int':
+        spelling = f'{"int" if var_type["sign"] else "uint"}{var_type["width"] * 8}_t'
+    elif kind == 'float':
+        spelling = f'float{var_type["width"] * 8}'
+    elif kind == 'func':
+        parameters = [render_type(parameter['type']) for parameter in var_type['params']]
+        if var_type.get('vararg'):
+            parameters.append('...')
+        spelling = f'{render_type(var_type["result"])} ({", ".join(parameters)})'
+    elif kind == 'struct':
+        members = '; '.join(f'{render_type(member["type"])} {member["name"]}'
+                            for member in var_type['struct']['members'])
+        spelling = f'{structure_types.get(var_type["struct"]["type"], "struct")} {{{members}}}'
+    elif kind == 'enum':
+        members = ', '.join(f'{member["name"]} = {member["value"]}' for member in var_type['enum']['members'])
+        spelling = f'enum {{{members}}}'
+    else:
+        spelling = kind
+    # Qualifiers of a pointer apply to the pointer itself, so they go after the '*' (e.g 'const IID * const').
+    for qualifier in ('volatile', 'const'):
+        if var_type.get(qualifier):
+            spelling = f'{spelling} {qualifier}' if kind == 'ptr' else f'{qualifier} {spelling}'
+    return spelling
+
+
+def type_signature(var_type: Dict) -> Dict:
+    kind = var_type['type']
+    signature = {'kind': kind, 'width': var_type.get('width')}
+    if kind == 'struct':
+        structure = var_type['struct']
+        signature['width'] = structure['width']
+        signature['structure_type'] = structure_types.get(structure['type'], structure['type'])
+        signature['alignment'] = structure.get('align')
+        signature['packed'] = structure.get('pack')
+        signature['fields'] = [{'name': member['name'], 'offset': member['offset'], 'type': render_type(member['type'])}
+                               for member in structure['members']]
+    elif kind == 'enum':
+        signature['members'] = [{'name': member['name'], 'value': member['value']}
+                                for member in var_type['enum']['members']]
+    elif kind == 'func':
+        signature['return_value'] = render_type(var_type['result'])
+        signature['calling_convention'] = var_type.get('convention')
+        signature['variable_arguments'] = bool(var_type.get('vararg'))
+        signature['parameters'] = [{'name': parameter['name'], 'type': render_type(parameter['type'])}
+                                   for parameter in var_type['params']]
+    elif kind == 'ptr':
+        signature['target'] = render_type(var_type['ref'])
+    elif kind == 'array':
+        signature['element_type'] = render_type(var_type['element'])
+        signature['count'] = var_type['count']
+    elif kind == 'name':
+        signature['reference'] = render_type(var_type)
+    else:
+        signature['type'] = render_type(var_type)
+    return signature
+
+
+def signature_hash(signature: Dict) -> str:
+    return xxhash.xxh64_hexdigest(json.dumps(signature, sort_keys=True).encode())
+
+
+def build_manifest(typelib: Dict) -> Dict:
+    # typelib is the JSON serialization of a typelib (see read_typelib()).
+    types = dict()
+    for named_type in typelib['types']:
+        signature = type_signature(named_type['type'])
+        types[qualified_name(named_type['name'])] = {'hash': signature_hash(signature), 'signature': signature}
+    return {'version': MANIFEST_VERSION, 'name': typelib.get('name'), 'types': types}
+
+
+def write_manifest(typelib_file: str, manifest_file: str):
+    # The manifest is built before the file is opened, so a failure doesn't leave an empty manifest behind.
+    manifest = build_manifest(read_typelib(typelib_file))
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def write_failed_manifest(manifest_file: str, error: Exception):
+    # Written in place of the manifest when the .btl could not be read (e.g the serialization format changed), so the
+    # build still has all of its outputs. load_manifest() raises on it and diffs fallback to an error.
+    with open(manifest_file, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'error': str(error), 'types': None}, f, indent=1, sort_keys=True)
+
+
+def load_manifest(path: str) -> Dict:
+    # path is either a manifest written by write_manifest() or a .btl file.
+    if path.endswith('.btl'):
+        return build_manifest(read_typelib(path))
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'load_manifest: Unsupported manifest version {manifest.get("version")} in {path}')
+    if manifest.get('error'):
+        raise ValueError(f'load_manifest: {path} was not built, the typelib could not be read: {manifest["error"]}')
+    return manifest
+
+
+def has_unique_names(items: List[Dict]) -> bool:
+    names = [item['name'] for item in items]
+    return '' not in names and len(set(names)) == len(names)
+
+
+def diff_items(old_items: List[Dict], new_items: List[Dict]) -> Dict:
+    # Diff two lists of named items (fields, parameters or enum members) by name.
+    # Unnamed or duplicate names (e.g function parameters without a name) are diffed by position instead.
+    if not has_unique_names(old_items) or not has_unique_names(new_items):
+        old_by_key = dict(enumerate(old_items))
+        new_by_key = dict(enumerate(new_items))
+    else:
+        old_by_key = {item['name']: item for item in old_items}
+        new_by_key = {item['name']: item for item in new_items}
+    return {
+        'added': [item for key, item in new_by_key.items() if key not in old_by_key],
+        'removed': [item for key, item in old_by_key.items() if key not in new_by_key],
+        'changed': [{'old': old_by_key[key], 'new': new_by_key[key]}
+                    for key in old_by_key if key in new_by_key and old_by_key[key] != new_by_key[key]]
+    }
+
+
+def diff_signatures(old_signature: Dict, new_signature: Dict) -> Dict:
+    # Field level detail of a changed type.
+    details = dict()
+    for key in sorted(set(old_signature) | set(new_signature)):
+        old_value = old_signature.get(key)
+        new_value = new_signature.get(key)
+        if old_value == new_value:
+            continue
+        if isinstance(old_value, list) and isinstance(new_value, list):
+            details[key] = diff_items(old_value, new_value)
+        else:
+            details[key] = {'old': old_value, 'new': new_value}
+    return details
+
+
+def diff(old_manifest: Dict, new_manifest: Dict) -> Dict:
+    old_types = old_manifest['types']
+    new_types = new_manifest['types']
+    changed = dict()
+    for name, new_entry in new_types.items():
+        old_entry = old_types.get(name)
+        if old_entry is not None and old_entry['hash'] != new_entry['hash']:
+            changed[name] = diff_signatures(old_entry['signature'], new_entry['signature'])
+    return {
+        'added': sorted(name for name in new_types if name not in old_types),
+        'removed': sorted(name for name in old_types if name not in new_types),
+        'changed': dict(sorted(changed.items()))
+    }
+
+
+def diff_files(old_path: str, new_path: str) -> Dict:
+    return diff(load_manifest(old_path), load_manifest(new_path))
+
+
+def format_report(report: Dict) -> str:
+    lines = [f'Added: {len(report["added"])}, Removed: {len(report["removed"])}, Changed: {len(report["changed"])}', '']
+    lines.extend(f'+ {name}' for name in report['added'])
+    lines.extend(f'- {name}' for name in report['removed'])
+    for name, details in report['changed'].items():
+        lines.append(f'~ {name}')
+        for key, detail in details.items():
+            if 'old' in detail:
+                lines.append(f'    {key}: {detail["old"]} -> {detail["new"]}')
+                continue
+            lines.extend(f'    {key} + {item}' for item in detail['added'])
+            lines.extend(f'    {key} - {item}' for item in detail['removed'])
+            lines.extend(f'    {key} ~ {item["old"]} -> {item["new"]}' for item in detail['changed'])
+    return '\n'.join(lines)